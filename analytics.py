@@ -0,0 +1,308 @@
+import glob
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Iterable, Optional
+
+WORD_RE = re.compile(r"[\w-]+")
+
+# Администраторы, которым доступны /stats и /stats_export (id через запятую)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+
+def analytics_path(module_file: str) -> Optional[str]:
+    """
+    Файл аналитики бота: ANALYTICS_DIR/analytics_<модуль>.json. Имя модуля
+    в пути не даёт ботам в одном процессе (multibot_host) писать в один файл.
+    Воркеры sharded_runner задают ANALYTICS_SHARD и пишут каждый в свой
+    файл с суффиксом ".<номер>". Пустой ANALYTICS_DIR отключает сохранение.
+    """
+    directory = os.getenv("ANALYTICS_DIR", ".")
+    if not directory:
+        return None
+    module = os.path.splitext(os.path.basename(module_file))[0]
+    path = os.path.join(directory, f"analytics_{module}.json")
+    shard = os.getenv("ANALYTICS_SHARD", "")
+    return f"{path}.{shard}" if shard else path
+
+
+def _shard_paths(path: str) -> list[str]:
+    """
+    Все файлы того же бота: общий и файлы воркеров (".<номер>").
+    """
+    base = path.rsplit(".", 1)[0] if path.rsplit(".", 1)[-1].isdigit() else path
+    paths = [base] + [
+        candidate for candidate in glob.glob(f"{glob.escape(base)}.*")
+        if candidate[len(base) + 1:].isdigit()
+    ]
+    return [candidate for candidate in paths if os.path.exists(candidate)]
+
+
+class SpaceSaving:
+    """
+    Компактный счётчик самых частых слов (алгоритм Space-Saving).
+
+    Хранит не больше capacity слов; при переполнении вытесняет самое редкое,
+    поэтому память ограничена, а частые слова считаются с небольшой погрешностью сверху.
+    Слова разложены по корзинам с одинаковым счётчиком (stream-summary),
+    поэтому и увеличение, и вытеснение занимают O(1).
+    """
+
+    def __init__(self, capacity: int = 100):
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        # счётчик -> слова с таким счётчиком (dict как упорядоченное множество)
+        self._buckets: dict[int, dict[str, None]] = {}
+        self._min_count = 0
+
+    def _place(self, word: str, count: int):
+        self.counts[word] = count
+        self._buckets.setdefault(count, {})[word] = None
+
+    def _unplace(self, word: str):
+        count = self.counts.pop(word)
+        bucket = self._buckets[count]
+        del bucket[word]
+        if not bucket:
+            del self._buckets[count]
+
+    def add(self, word: str):
+        count = self.counts.get(word)
+        if count is not None:
+            self._unplace(word)
+            self._place(word, count + 1)
+            if count == self._min_count and count not in self._buckets:
+                self._min_count = count + 1
+            return
+        if len(self.counts) < self.capacity:
+            self._place(word, 1)
+            self._min_count = 1
+            return
+        # Вытесняем самое давнее из самых редких и наследуем его счётчик
+        rarest = next(iter(self._buckets[self._min_count]))
+        count = self._min_count
+        self._unplace(rarest)
+        self._place(word, count + 1)
+        if count not in self._buckets:
+            self._min_count = count + 1
+
+    def load(self, counts: dict[str, int]):
+        """
+        Восстанавливает счётчик из сохранённых частот.
+        """
+        self.counts, self._buckets = {}, {}
+        for word, count in sorted(counts.items(), key=lambda item: -item[1])[:self.capacity]:
+            self._place(word, count)
+        self._min_count = min(self._buckets, default=0)
+
+    def top(self, n: int = 10) -> list[tuple[str, int]]:
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+class YearCompassAnalytics:
+    """
+    Инкрементальная аналитика ответов YearCompass.
+
+    Агрегаты обновляются при каждом ответе за O(1): сколько сессий начато,
+    сколько ответов получено на каждый вопрос (воронка и точки отвала)
+    и частоты слов для вопросов «опиши тремя словами». Сами ответы не хранятся.
+    """
+
+    def __init__(
+        self,
+        num_questions: int,
+        word_questions: Iterable[int] = (),
+        path: Optional[str] = None,
+        flush_interval: float = 60,
+        word_capacity: int = 100,
+    ):
+        self.num_questions = num_questions
+        self.word_questions = set(word_questions)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.started = 0
+        self.answered = [0] * num_questions
+        self.words = {index: SpaceSaving(word_capacity) for index in self.word_questions}
+        self._last_flush = time.time()
+        self._flush_lock = threading.Lock()
+        self._load()
+
+    def on_start(self):
+        """
+        Пользователь начал (или перезапустил) упражнение.
+        """
+        self.started += 1
+        self.maybe_flush()
+
+    def on_answer(self, question_index: int, text: str):
+        """
+        Получен ответ на вопрос question_index (считая с нуля).
+        """
+        if not 0 <= question_index < self.num_questions:
+            return
+        self.answered[question_index] += 1
+        counter = self.words.get(question_index)
+        if counter is not None:
+            # В «трёх словах» учитываем только первые несколько слов ответа
+            for word in WORD_RE.findall(text.lower())[:5]:
+                if len(word) > 1:
+                    counter.add(word)
+        self.maybe_flush()
+
+    def funnel(self) -> list[dict]:
+        """
+        Воронка по вопросам: сколько дошло до вопроса, сколько ответило
+        и сколько остановилось на нём (включая тех, кто проходит его прямо сейчас).
+        """
+        rows = []
+        reached = self.started
+        for index, answered in enumerate(self.answered):
+            rows.append({
+                "question": index + 1,
+                "reached": reached,
+                "answered": answered,
+                "dropped": max(0, reached - answered),
+            })
+            reached = answered
+        return rows
+
+    def _state(self) -> dict:
+        return {
+            "started": self.started,
+            "answered": self.answered,
+            "words": {str(index): counter.counts for index, counter in self.words.items()},
+        }
+
+    def export(self) -> dict:
+        """
+        Сводные данные. При запуске в нескольких воркерах (sharded_runner)
+        складываются файлы всех воркеров, а не только текущего процесса.
+        """
+        states = [self._state()]
+        if self.path:
+            self.flush()
+            for path in _shard_paths(self.path):
+                if os.path.abspath(path) == os.path.abspath(self.path):
+                    continue
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        states.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logging.error(f"Не удалось прочитать аналитику YearCompass из {path}: {e}")
+
+        merged = YearCompassAnalytics(self.num_questions, self.word_questions)
+        words = {index: {} for index in self.word_questions}
+        for state in states:
+            merged.started += state.get("started", 0)
+            answered = state.get("answered", [])
+            if len(answered) == self.num_questions:
+                merged.answered = [total + count for total, count in zip(merged.answered, answered)]
+            for index, counts in state.get("words", {}).items():
+                totals = words.get(int(index))
+                if totals is not None:
+                    for word, count in counts.items():
+                        totals[word] = totals.get(word, 0) + count
+
+        return {
+            "started": merged.started,
+            "completed": merged.answered[-1] if merged.answered else 0,
+            "funnel": merged.funnel(),
+            "words": {
+                str(index + 1): sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+                for index, counts in sorted(words.items())
+            },
+        }
+
+    def report(self, questions: list[str]) -> str:
+        """
+        Текстовый отчёт для команды /stats.
+        """
+        data = self.export()
+        completion = data["completed"] / data["started"] * 100 if data["started"] else 0
+        lines = [
+            f"Начато сессий: {data['started']}",
+            f"Завершено: {data['completed']} ({completion:.0f}%)",
+            "",
+            "Воронка (дошли → ответили, отвалились):",
+        ]
+        for row in data["funnel"]:
+            lines.append(f"{row['question']}) {row['reached']} → {row['answered']}, −{row['dropped']}")
+        for index in sorted(self.word_questions):
+            top = ", ".join(f"{word} ({count})" for word, count in data["words"][str(index + 1)][:10]) or "—"
+            lines += ["", f"{questions[index]}", f"Частые слова: {top}"]
+        return "\n".join(lines)
+
+    def maybe_flush(self):
+        now = time.time()
+        with self._flush_lock:
+            if now - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = now
+        self.flush()
+
+    def flush(self):
+        """
+        Сохраняет агрегаты в JSON-файл (через уникальный временный файл, атомарно).
+        Одновременные сохранения выполняются по очереди.
+        """
+        with self._flush_lock:
+            self._last_flush = time.time()
+            if not self.path:
+                return
+            state = json.dumps(self._state(), ensure_ascii=False)
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                prefix=f"{os.path.basename(self.path)}.", suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(state)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logging.error(f"Не удалось сохранить аналитику YearCompass: {e}")
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось загрузить аналитику YearCompass: {e}")
+            return
+        self.started = state.get("started", 0)
+        answered = state.get("answered", [])
+        if len(answered) == self.num_questions:
+            self.answered = answered
+        for index, counts in state.get("words", {}).items():
+            counter = self.words.get(int(index))
+            if counter is not None:
+                counter.load(counts)
+
+
+def admin_handlers(analytics: YearCompassAnalytics, questions: list[str]):
+    """
+    Команды администратора: /stats — отчёт в чат, /stats_export — JSON-файлом.
+    Доступны только пользователям из ADMIN_IDS.
+    """
+    from telegram import Update
+    from telegram.ext import CommandHandler, ContextTypes
+
+    async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        await update.message.reply_text(analytics.report(questions))
+
+    async def stats_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        payload = json.dumps(analytics.export(), ensure_ascii=False, indent=2).encode("utf-8")
+        await update.message.reply_document(io.BytesIO(payload), filename="yearcompass_stats.json")
+
+    return [CommandHandler("stats", stats), CommandHandler("stats_export", stats_export)]
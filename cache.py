@@ -0,0 +1,39 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    LRU-кэш ответов ChatGPT с ограниченным временем жизни записей.
+
+    Ключ — нормализованный вопрос (регистр и лишние пробелы не учитываются).
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        return " ".join(prompt.lower().split())
+
+    def get(self, prompt: str) -> Optional[str]:
+        key = self.key(prompt)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, answer = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return answer
+
+    def set(self, prompt: str, answer: str):
+        key = self.key(prompt)
+        self._entries[key] = (time.monotonic() + self.ttl, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from typing import Awaitable, Dict, Hashable, Optional, Set, TypeVar
+
+T = TypeVar("T")
+
+
+class ChatRequestTracker:
+    """
+    Отслеживает незавершённые запросы к OpenAI/DALL·E по ключу — чату
+    или, в ботах с группами, паре (чат, пользователь).
+
+    Новый запрос (или перезапуск сессии через /start) отменяет все
+    предыдущие задачи с тем же ключом, а их ответы не отправляются пользователю.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, Set[asyncio.Task]] = {}
+
+    async def run(self, chat_id: Hashable, coro: Awaitable[T], supersede: bool = True) -> Optional[T]:
+        """
+        Запускает корутину как задачу чата и дожидается её результата.
+
+        Если supersede=True, предварительно отменяет прежние задачи этого чата.
+        Возвращает None, если задачу отменил более новый запрос —
+        в этом случае вызывающий код не должен ничего отвечать.
+        """
+        if supersede:
+            self.cancel_chat(chat_id)
+
+        task = asyncio.ensure_future(coro)
+        tasks = self._tasks.setdefault(chat_id, set())
+        tasks.add(task)
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                logging.info(f"Запрос в чате {chat_id} отменён более новым запросом")
+                return None
+            # Отменили сам обработчик (например, при остановке бота) — отменяем и задачу
+            task.cancel()
+            raise
+        finally:
+            tasks.discard(task)
+            if not tasks:
+                self._tasks.pop(chat_id, None)
+
+    def cancel_chat(self, chat_id: Hashable) -> int:
+        """
+        Отменяет все незавершённые задачи чата и возвращает их количество.
+        """
+        cancelled = 0
+        for task in list(self._tasks.get(chat_id, ())):
+            if not task.done():
+                task.cancel()
+                cancelled += 1
+        if cancelled:
+            logging.info(f"Отменено незавершённых запросов в чате {chat_id}: {cancelled}")
+        return cancelled
+
+    def pending(self, chat_id: Hashable) -> int:
+        """
+        Количество незавершённых задач чата.
+        """
+        return sum(1 for task in self._tasks.get(chat_id, ()) if not task.done())
@@ -1,20 +1,27 @@
 import os
+import asyncio
+import hashlib
 import logging
-import aiohttp
-import openai
-import nest_asyncio
 
-from telegram import Update
+from startup import lazy_import, prefetch, startup_timer, track_first_update
+from cache import ResponseCache
+from inflight import ChatRequestTracker
+from memory import ConversationMemory
+from quotas import UsageMeter
+from traffic import install_capture
+from tracing import span, trace_update, traced_request
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
 
-# Применяем nest_asyncio для разрешения проблемы с вложенными event loop'ами
-nest_asyncio.apply()
+startup_timer.mark("импорт telegram.ext")
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,37 +33,132 @@ logging.basicConfig(
 TELEGRAM_BOT_TOKEN = os.getenv("BOT_TOKEN", "<YOUR_TELEGRAM_BOT_TOKEN>")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "<YOUR_OPENAI_API_KEY>")
 
-# Инициализация OpenAI API
-openai.api_key = OPENAI_API_KEY
+# Тяжёлые модули импортируются при первом использовании (или заранее в фоне, см. main()),
+# чтобы бот начинал принимать обновления как можно раньше после деплоя.
+# Ключ OpenAI выставляется сразу после импорта.
+openai = lazy_import("openai", configure=lambda module: setattr(module, "api_key", OPENAI_API_KEY))
+aiohttp = lazy_import("aiohttp")
 
+# Незавершённые запросы к OpenAI по чатам: новый запрос отменяет предыдущие
+request_tracker = ChatRequestTracker()
 
-async def get_chatgpt_response(prompt: str) -> str:
+# Квоты на запросы, токены и картинки по пользователям и чатам (со сбросом на диск)
+usage_meter = UsageMeter(path=os.getenv("USAGE_FILE", "usage.json"))
+
+QUOTA_EXCEEDED_TEXT = "Слишком много запросов. Пожалуйста, попробуйте позже."
+
+# Кэш ответов на вопросы без контекста диалога (первый вопрос в чате и inline-режим)
+response_cache = ResponseCache(max_size=1000, ttl=3600)
+
+# Inline-режим: ждём, пока пользователь перестанет печатать, прежде чем идти в OpenAI
+INLINE_DEBOUNCE_SECONDS = 0.8
+# Сколько секунд Telegram может сам отдавать наш ответ на такой же inline-запрос
+INLINE_CACHE_TIME = 300
+# Сколько ждём OpenAI ради inline-ответа: вместе с debounce это меньше срока,
+# после которого Telegram отвергает answerInlineQuery ("query is too old")
+INLINE_OPENAI_TIMEOUT = 7
+
+# Незавершённые inline-запросы по пользователям: новый запрос отменяет предыдущий
+inline_tracker = ChatRequestTracker()
+# id последнего inline-запроса каждого пользователя (для debounce)
+inline_latest_query: dict[int, str] = {}
+
+
+async def summarize_history(chat_id: int, summary: str, messages: list[dict]) -> str:
+    """
+    Сворачивает старые реплики диалога (и прежнее резюме) в новое краткое резюме.
+    Токены сжатия идут в квоту чата: это фоновая работа, а не запрос пользователя.
+    """
+    history = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    with span("openai.summary"):
+        response = await openai.ChatCompletion.acreate(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "Кратко перескажи разговор, сохранив факты, имена и договорённости."},
+                {"role": "user", "content": f"Прежнее резюме: {summary or '—'}\n\nНовые реплики:\n{history}"},
+            ],
+            temperature=0.2,
+            max_tokens=300
+        )
+    usage_meter.record(None, chat_id, "tokens", response["usage"]["total_tokens"])
+    return response["choices"][0]["message"]["content"]
+
+
+# Память диалогов amybot: последние реплики дословно, старые — в виде резюме.
+# Промпт не превышает 3000 токенов, поэтому время ответа не растёт с длиной переписки.
+conversation_memory = ConversationMemory(summarize_history, max_prompt_tokens=3000, recent_tokens=1500)
+
+
+async def get_chatgpt_response(chat_id: int, user_id: int, prompt: str) -> str:
     """
     Отправляет запрос к ChatGPT с использованием модели GPT-4 и возвращает сгенерированный ответ.
+    В запрос добавляется контекст предыдущих реплик этого чата.
+    Первый вопрос в чате (без контекста) обслуживается через общий кэш ответов.
     """
+    # Без контекста ответ зависит только от вопроса — его можно взять из кэша
+    cacheable = not conversation_memory.has_context(chat_id)
+    if cacheable:
+        cached = response_cache.get(prompt)
+        if cached is not None:
+            conversation_memory.add_turn(chat_id, prompt, cached)
+            return cached
+
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=512
-        )
-        return response["choices"][0]["message"]["content"]
+        with span("openai.chat"):
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-4",
+                messages=conversation_memory.build_messages(chat_id, prompt),
+                temperature=0.7,
+                max_tokens=512
+            )
+        answer = response["choices"][0]["message"]["content"]
+        usage_meter.record(user_id, chat_id, "tokens", response["usage"]["total_tokens"])
+        conversation_memory.add_turn(chat_id, prompt, answer)
+        if cacheable:
+            response_cache.set(prompt, answer)
+        return answer
     except Exception as e:
         logging.error(f"Ошибка при запросе к ChatGPT: {e}")
         return "Произошла ошибка при обращении к ChatGPT."
 
 
+async def get_inline_response(user_id: int, prompt: str):
+    """
+    Отвечает на inline-вопрос без контекста диалога через общий кэш ответов.
+    Возвращает None, если ответ получить не удалось.
+    """
+    cached = response_cache.get(prompt)
+    if cached is not None:
+        return cached
+
+    try:
+        with span("openai.chat"):
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-4",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.7,
+                max_tokens=512
+            )
+        answer = response["choices"][0]["message"]["content"]
+        usage_meter.record(user_id, f"inline:{user_id}", "tokens", response["usage"]["total_tokens"])
+        response_cache.set(prompt, answer)
+        return answer
+    except Exception as e:
+        logging.error(f"Ошибка при inline-запросе к ChatGPT: {e}")
+        return None
+
+
 async def generate_dalle_image(prompt: str) -> str:
     """
     Генерирует изображение с помощью DALL·E и возвращает URL сгенерированного изображения.
     """
     try:
-        response = openai.Image.create(
-            prompt=prompt,
-            n=1,
-            size="512x512"
-        )
+        with span("openai.image"):
+            response = await openai.Image.acreate(
+                prompt=prompt,
+                n=1,
+                size="512x512"
+            )
         image_url = response['data'][0]['url']
         return image_url
     except Exception as e:
@@ -70,9 +172,10 @@ async def get_btc_price() -> str:
     """
     try:
         url = "https://api.coindesk.com/v1/bpi/currentprice/BTC.json"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.json()
+        with span("coindesk.price"):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as response:
+                    data = await response.json()
         price = data["bpi"]["USD"]["rate"]  # строка вида '23,456.78'
         return f"Текущая цена биткоина: {price} USD"
     except Exception as e:
@@ -80,18 +183,31 @@ async def get_btc_price() -> str:
         return "Не удалось получить цену биткоина."
 
 
+def request_key(update: Update) -> tuple[int, int]:
+    """
+    Ключ незавершённых запросов: новый запрос пользователя заменяет только его
+    собственный прежний запрос, а не запросы других участников группы.
+    """
+    return update.effective_chat.id, update.effective_user.id
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработчик команды /start, приветствующий пользователя.
+    Перезапуск отменяет незавершённые запросы этого пользователя и очищает историю диалога.
     """
+    request_tracker.cancel_chat(request_key(update))
+    conversation_memory.clear(update.effective_chat.id)
     await update.message.reply_text(
         "Привет! Я бот, который может отвечать на вопросы, генерировать изображения и сообщать цену биткоина.\n\n"
         "• Напишите 'amybot' для обращения к ChatGPT;\n"
         "• Используйте 'нарисуй' или 'сделай картинку' для генерации изображения;\n"
-        "• Отправьте '$' для получения цены биткоина."
+        "• Отправьте '$' для получения цены биткоина;\n"
+        "• Наберите '@имя_бота вопрос' в любом чате, чтобы спросить ChatGPT в inline-режиме."
     )
 
 
+@trace_update
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Главный обработчик текстовых сообщений.
@@ -114,10 +230,18 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 2. Если сообщение содержит ключевые слова для генерации изображения
     if "нарисуй" in message_text or "сделай картинку" in message_text:
+        if not usage_meter.try_acquire(update.effective_user.id, update.effective_chat.id, "requests", "images"):
+            await update.message.reply_text(QUOTA_EXCEEDED_TEXT)
+            return
         prompt_for_dalle = update.message.text
         placeholder_msg = await update.message.reply_text("Рисую, подождите...")
-        image_url = await generate_dalle_image(prompt_for_dalle)
+        image_url = await request_tracker.run(
+            request_key(update), generate_dalle_image(prompt_for_dalle)
+        )
         await placeholder_msg.delete()
+        if image_url is None:
+            # Запрос отменён более новым сообщением — старый рисунок не нужен
+            return
         if image_url:
             await update.message.reply_photo(photo=image_url, caption="Вот ваш рисунок!")
         else:
@@ -129,25 +253,120 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_prompt = update.message.text.replace("amybot", "").strip()
         if not user_prompt:
             user_prompt = "Привет!"
-        chatgpt_answer = await get_chatgpt_response(user_prompt)
+        if not usage_meter.try_acquire(update.effective_user.id, update.effective_chat.id, "requests", "tokens"):
+            await update.message.reply_text(QUOTA_EXCEEDED_TEXT)
+            return
+        chatgpt_answer = await request_tracker.run(
+            request_key(update), get_chatgpt_response(
+                update.effective_chat.id, update.effective_user.id, user_prompt
+            )
+        )
+        if chatgpt_answer is None:
+            # Пользователь уже отправил новый запрос — устаревший ответ не отправляем
+            return
         await update.message.reply_text(chatgpt_answer)
 
 
-async def main():
+@trace_update
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Основная функция для создания и запуска приложения Telegram.
+    Обработчик inline-запросов вида '@bot вопрос'.
+
+    Telegram присылает запрос на каждое нажатие клавиши, поэтому ответ
+    формируется только для «устоявшегося» запроса: если за время ожидания
+    пришёл новый запрос от того же пользователя, старый просто отбрасывается.
+    """
+    inline_query = update.inline_query
+    prompt = inline_query.query.strip()
+    if not prompt:
+        return
+
+    user_id = inline_query.from_user.id
+    inline_latest_query[user_id] = inline_query.id
+    await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+    if inline_latest_query.get(user_id) != inline_query.id:
+        return
+    inline_latest_query.pop(user_id, None)
+
+    answer = response_cache.get(prompt)
+    if answer is None:
+        # Inline-запросы считаются в квоте пользователя и в отдельной «чатовой» квоте,
+        # не расходуя квоту его личного чата с ботом
+        if not usage_meter.try_acquire(user_id, f"inline:{user_id}", "requests", "tokens"):
+            return
+        task = asyncio.ensure_future(inline_tracker.run(user_id, get_inline_response(user_id, prompt)))
+        try:
+            answer = await asyncio.wait_for(asyncio.shield(task), INLINE_OPENAI_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Отвечать уже поздно; запрос досчитается в фоне и попадёт в кэш для повторного набора
+            logging.info(f"OpenAI не успел ответить на inline-запрос пользователя {user_id}")
+            return
+        if not answer:
+            # Отменён более новым запросом или ошибка OpenAI
+            return
+
+    result = InlineQueryResultArticle(
+        id=hashlib.md5(response_cache.key(prompt).encode()).hexdigest(),
+        title="AmyBot",
+        description=answer[:100],
+        input_message_content=InputTextMessageContent(f"{prompt}\n\n{answer}"[:4096]),
+    )
+    try:
+        await inline_query.answer([result], cache_time=INLINE_CACHE_TIME)
+    except BadRequest as e:
+        logging.error(f"Ошибка при ответе на inline-запрос: {e}")
+
+
+async def flush_usage(application):
     """
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    Сохраняет счётчики квот на диск при остановке приложения.
+    """
+    usage_meter.flush()
+
+
+def build_application(token: str = TELEGRAM_BOT_TOKEN, request=None):
+    """
+    Создаёт приложение Telegram со всеми обработчиками, но не запускает его.
+    request — общий HTTP-транспорт, если в процессе работает несколько ботов.
+    """
+    # concurrent_updates нужен, чтобы новое сообщение обрабатывалось, пока идёт
+    # предыдущий запрос к OpenAI, и могло его отменить
+    builder = ApplicationBuilder().token(token).concurrent_updates(True).post_shutdown(flush_usage)
+    # При включённой трассировке каждый вызов Bot API попадает в трассу
+    request = traced_request(request)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+
+    # При заданном CAPTURE_FILE записываем входящие обновления для последующего воспроизведения
+    install_capture(application)
+    return application
+
+
+async def main():
+    """
+    Основная функция для создания и запуска приложения Telegram.
+    """
+    application = build_application(TELEGRAM_BOT_TOKEN)
+    track_first_update(application)
+    startup_timer.mark("сборка приложения")
+
+    # Догружаем openai и aiohttp в фоне, пока идёт подключение к Telegram
+    prefetch(openai, aiohttp)
 
     # Передаём close_loop=False, чтобы не пытаться закрыть уже работающий event loop
     await application.run_polling(close_loop=False)
 
 
 if __name__ == "__main__":
-    import asyncio
+    import nest_asyncio
+
+    # Применяем nest_asyncio для разрешения проблемы с вложенными event loop'ами
+    nest_asyncio.apply()
     try:
         asyncio.run(main())
     except RuntimeError as e:
@@ -1,8 +1,14 @@
+import atexit
 import os
-import requests
+import signal
+import sys
 from flask import Flask, request
 import telegram
-import openai
+
+from startup import lazy_import, prefetch
+from quotas import UsageMeter
+from tracing import span, trace_update
+from traffic import capture_update
 
 app = Flask(__name__)
 
@@ -10,13 +16,23 @@ TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 APP_URL = os.environ.get("APP_URL", "")  # Например: "https://имя-приложения.up.railway.app"
 
-openai.api_key = OPENAI_API_KEY
+# openai и requests импортируются при первом использовании (или заранее в фоне, см. __main__),
+# чтобы Flask быстрее начинал принимать webhook. Ключ OpenAI выставляется сразу после импорта.
+openai = lazy_import("openai", configure=lambda module: setattr(module, "api_key", OPENAI_API_KEY))
+requests = lazy_import("requests")
 bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
 
+# Квоты на запросы, токены и картинки по пользователям и чатам (со сбросом на диск)
+usage_meter = UsageMeter(path=os.environ.get("USAGE_FILE", "usage.json"))
+# Сохраняем счётчики при остановке процесса, иначе теряется до flush_interval секунд учёта
+atexit.register(usage_meter.flush)
+QUOTA_EXCEEDED_TEXT = "Слишком много запросов, попробуй позже."
+
 def get_bitcoin_price():
     try:
         url = "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd"
-        data = requests.get(url).json()
+        with span("coingecko.price"):
+            data = requests.get(url).json()
         return data["bitcoin"]["usd"]
     except:
         return "N/A"
@@ -26,6 +42,7 @@ def get_oil_price():
     # Если нужно, интегрируйте реальный API для котировок нефти.
     return 70
 
+@trace_update
 def handle_message(msg: telegram.Message):
     text = (msg.text or "").strip()
 
@@ -35,9 +52,13 @@ def handle_message(msg: telegram.Message):
 
     # "AmyBot, нарисуй..." => генерация картинки
     if text.lower().startswith("amybot, нарисуй"):
+        if not usage_meter.try_acquire(msg.from_user.id, msg.chat.id, "requests", "images"):
+            msg.reply_text(QUOTA_EXCEEDED_TEXT)
+            return
         prompt = text[len("Amybot, нарисуй"):].strip() or "красивая картинка"
         try:
-            response = openai.Image.create(prompt=prompt, n=1, size="512x512")
+            with span("openai.image"):
+                response = openai.Image.create(prompt=prompt, n=1, size="512x512")
             img_url = response['data'][0]['url']
             msg.reply_photo(photo=img_url)
         except:
@@ -52,33 +73,44 @@ def handle_message(msg: telegram.Message):
         return
 
     # Иначе — шлём в ChatCompletion
+    if not usage_meter.try_acquire(msg.from_user.id, msg.chat.id, "requests", "tokens"):
+        msg.reply_text(QUOTA_EXCEEDED_TEXT)
+        return
     system_prompt = (
         "Ты — AmyBot, креативный профессионал. Любишь кофе, гаджеты и путешествия. "
         "Отвечай по существу, но интересно."
     )
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text}
-            ],
-            temperature=0.1,
-            max_tokens=200
-        )
+        with span("openai.chat"):
+            response = openai.ChatCompletion.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": text}
+                ],
+                temperature=0.1,
+                max_tokens=200
+            )
         answer = response["choices"][0]["message"]["content"]
+        usage_meter.record(msg.from_user.id, msg.chat.id, "tokens", response["usage"]["total_tokens"])
         msg.reply_text(answer)
     except:
         msg.reply_text("Упс, что-то пошло не так при запросе к OpenAI.")
 
 @app.route("/", methods=["POST"])
+@trace_update
 def webhook():
-    update = telegram.Update.de_json(request.get_json(force=True), bot)
+    data = request.get_json(force=True)
+    capture_update(data)
+    update = telegram.Update.de_json(data, bot)
     if update.message:
         handle_message(update.message)
     return "OK"
 
 if __name__ == "__main__":
+    # Railway останавливает контейнер SIGTERM'ом; sys.exit запускает обработчики atexit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    prefetch(openai, requests)
     if APP_URL:
         bot.set_webhook(APP_URL)
         print(f"Webhook установлен на {APP_URL}")
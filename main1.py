@@ -1,6 +1,9 @@
 import os
 import logging
 
+from analytics import YearCompassAnalytics, admin_handlers, analytics_path
+from traffic import install_capture
+from tracing import trace_update, traced_request
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (
     ApplicationBuilder,
@@ -30,6 +33,15 @@ questions = [
     "9) Опиши тремя словами свои надежды на следующий год."
 ]
 
+# Агрегаты по ответам (воронка, отвал, частые слова) — обновляются на каждом ответе.
+# Вопросы 8 и 9 («опиши тремя словами») считаем по словам.
+# У каждого бота (и каждого воркера sharded_runner) свой файл, см. analytics_path.
+analytics = YearCompassAnalytics(
+    len(questions),
+    word_questions=(7, 8),
+    path=analytics_path(__file__),
+)
+
 def generate_final_message(answers: list[str]) -> str:
     text = (
         "Спасибо, что поделился(ась) своими мыслями! \n\n"
@@ -54,6 +66,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     # Очищаем/инициализируем данные пользователя
     context.user_data[user_id] = {"answers": [], "current_question": 0}
+    analytics.on_start()
     await update.message.reply_text(
         "Привет! Я проведу тебя через упражнение YearCompass.\n"
         "Давай начнём. Пожалуйста, отвечай на вопросы по порядку.\n\n"
@@ -61,6 +74,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return QUESTION_1
 
+@trace_update
 async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_data = context.user_data.get(user_id, {})
@@ -79,6 +93,7 @@ async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем ответ
     answers = user_data.get("answers", [])
     answers.append(message_text)
+    analytics.on_answer(current_question_index, message_text)
     user_data["answers"] = answers
     user_data["current_question"] = current_question_index + 1
     context.user_data[user_id] = user_data
@@ -104,13 +119,23 @@ async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return current_question_index
 
-def main():
-    # Считываем токен из переменной окружения Railway (TELEGRAM_BOT_TOKEN)
-    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
-    if not bot_token:
-        raise ValueError("Не найден TELEGRAM_BOT_TOKEN в переменных окружения.")
-
-    application = ApplicationBuilder().token(bot_token).build()
+async def flush_analytics(application):
+    """
+    Сохраняет аналитику на диск при остановке приложения.
+    """
+    analytics.flush()
+
+def build_application(token: str, request=None):
+    """
+    Создаёт приложение бота со всеми обработчиками, но не запускает его.
+    request — общий HTTP-транспорт, если в процессе работает несколько ботов.
+    """
+    builder = ApplicationBuilder().token(token).post_shutdown(flush_analytics)
+    # При включённой трассировке каждый вызов Bot API попадает в трассу
+    request = traced_request(request)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -138,7 +163,23 @@ def main():
         allow_reentry=True
     )
 
+    # Команды администратора (/stats, /stats_export) регистрируем до диалога,
+    # чтобы они не попадали в fallback упражнения
+    for handler in admin_handlers(analytics, questions):
+        application.add_handler(handler)
     application.add_handler(conv_handler)
+
+    # При заданном CAPTURE_FILE записываем входящие обновления для последующего воспроизведения
+    install_capture(application)
+    return application
+
+def main():
+    # Считываем токен из переменной окружения Railway (TELEGRAM_BOT_TOKEN)
+    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not bot_token:
+        raise ValueError("Не найден TELEGRAM_BOT_TOKEN в переменных окружения.")
+
+    application = build_application(bot_token)
     application.run_polling()
 
 if __name__ == "__main__":
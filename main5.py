@@ -1,7 +1,11 @@
 import os
 import logging
-import openai
 
+from startup import lazy_import, prefetch, startup_timer, track_first_update
+from inflight import ChatRequestTracker
+from analytics import YearCompassAnalytics, admin_handlers, analytics_path
+from traffic import install_capture
+from tracing import span, trace_update, traced_request
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (
     ApplicationBuilder,
@@ -12,6 +16,11 @@ from telegram.ext import (
     ContextTypes,
 )
 
+startup_timer.mark("импорт telegram.ext")
+
+# openai импортируется при первом использовании (или заранее в фоне, см. main())
+openai = lazy_import("openai")
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -32,7 +41,20 @@ questions = [
     "9) Опиши тремя словами свои надежды на следующий год."
 ]
 
-def generate_gpt_summary(answers: list[str]) -> str:
+# Агрегаты по ответам (воронка, отвал, частые слова) — обновляются на каждом ответе.
+# Вопросы 8 и 9 («опиши тремя словами») считаем по словам.
+# У каждого бота (и каждого воркера sharded_runner) свой файл, см. analytics_path.
+analytics = YearCompassAnalytics(
+    len(questions),
+    word_questions=(7, 8),
+    path=analytics_path(__file__),
+)
+
+# Незавершённые GPT-запросы по (чат, пользователь): /start отменяет запрос от прошлой сессии
+# этого пользователя, не трогая сессии других участников группы
+request_tracker = ChatRequestTracker()
+
+async def generate_gpt_summary(answers: list[str]) -> str:
     """
     Вызывает ChatGPT, передаёт ему ответы пользователя и возвращает
     ироничный и поддерживающий комментарий + рекомендации на будущее.
@@ -65,16 +87,16 @@ def generate_gpt_summary(answers: list[str]) -> str:
     )
 
     try:
-        response = openai.ChatCompletion.create(
-            response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=messages
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.7,   # Настройка «творчества»
-            max_tokens=700,    # Примерный лимит токенов в ответе
-        )
+        with span("openai.chat"):
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=0.7,   # Настройка «творчества»
+                max_tokens=700,    # Примерный лимит токенов в ответе
+            )
         gpt_reply = response["choices"][0]["message"]["content"]
         return gpt_reply.strip()
 
@@ -91,6 +113,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     user_id = update.effective_user.id
     context.user_data[user_id] = {"answers": [], "current_question": 0}
+    analytics.on_start()
+    # Итоги прошлой сессии больше не нужны
+    request_tracker.cancel_chat((update.effective_chat.id, update.effective_user.id))
 
     # Приветственное сообщение с объяснением бота
     welcome_text = (
@@ -129,6 +154,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(help_text)
 
+@trace_update
 async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Принимаем ответ на текущий вопрос. Если это не команда,
@@ -151,6 +177,7 @@ async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем ответ
     answers = user_data.get("answers", [])
     answers.append(message_text)
+    analytics.on_answer(current_question_index, message_text)
     user_data["answers"] = answers
 
     # Переходим к следующему вопросу
@@ -163,15 +190,27 @@ async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(questions[next_question_index])
         return next_question_index
     else:
-        # Все вопросы пройдены — формируем GPT-анализ
-        gpt_msg = generate_gpt_summary(answers)
-        # Отправляем пользователю
-        await update.message.reply_text(
-            gpt_msg,
-            reply_markup=ReplyKeyboardRemove()
-        )
+        # Все вопросы пройдены — GPT-анализ готовим в фоне и сразу завершаем диалог,
+        # чтобы следующие сообщения (в том числе /start) не ждали ответа OpenAI
+        context.application.create_task(send_gpt_summary(update, answers), update=update)
         return ConversationHandler.END
 
+async def send_gpt_summary(update: Update, answers: list[str]):
+    """
+    Фоновая задача: получает GPT-анализ и отправляет его пользователю.
+    Если пользователь тем временем начал упражнение заново (/start), запрос отменяется.
+    """
+    gpt_msg = await request_tracker.run(
+        (update.effective_chat.id, update.effective_user.id), generate_gpt_summary(answers)
+    )
+    if gpt_msg is None:
+        return
+    # Отправляем пользователю
+    await update.message.reply_text(
+        gpt_msg,
+        reply_markup=ReplyKeyboardRemove()
+    )
+
 async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Если пользователь пишет что-то не в ответ на вопрос,
@@ -187,14 +226,23 @@ async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return current_question_index
 
-def main():
-    # Считываем токен бота из переменной окружения
-    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
-    if not bot_token:
-        raise ValueError("Не найден TELEGRAM_BOT_TOKEN в переменных окружения.")
+async def flush_analytics(application):
+    """
+    Сохраняет аналитику на диск при остановке приложения.
+    """
+    analytics.flush()
 
-    # Создаём приложение бота
-    application = ApplicationBuilder().token(bot_token).build()
+def build_application(token: str, request=None):
+    """
+    Создаёт приложение бота со всеми обработчиками, но не запускает его.
+    request — общий HTTP-транспорт, если в процессе работает несколько ботов.
+    """
+    builder = ApplicationBuilder().token(token).post_shutdown(flush_analytics)
+    # При включённой трассировке каждый вызов Bot API попадает в трассу
+    request = traced_request(request)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
 
     # Конфигурируем хендлер команды /help
     help_handler = CommandHandler("help", help_command)
@@ -228,8 +276,31 @@ def main():
 
     # Регистрируем хендлеры
     application.add_handler(help_handler)
+
+    # Команды администратора (/stats, /stats_export) регистрируем до диалога,
+    # чтобы они не попадали в fallback упражнения
+    for handler in admin_handlers(analytics, questions):
+        application.add_handler(handler)
     application.add_handler(conv_handler)
 
+    # При заданном CAPTURE_FILE записываем входящие обновления для последующего воспроизведения
+    install_capture(application)
+    return application
+
+def main():
+    # Считываем токен бота из переменной окружения
+    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not bot_token:
+        raise ValueError("Не найден TELEGRAM_BOT_TOKEN в переменных окружения.")
+
+    # Создаём приложение бота
+    application = build_application(bot_token)
+    track_first_update(application)
+    startup_timer.mark("сборка приложения")
+
+    # Догружаем openai в фоне, пока идёт подключение к Telegram
+    prefetch(openai)
+
     # Запускаем бота (polling)
     application.run_polling()
 
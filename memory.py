@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, List, Optional
+
+# Грубая оценка: ~3 символа на токен (с запасом для кириллицы)
+# плюс служебные токены на каждое сообщение
+CHARS_PER_TOKEN = 3
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "Краткое содержание предыдущего разговора: "
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценивает количество токенов в тексте без обращения к токенизатору.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def message_tokens(message: dict) -> int:
+    """
+    Оценивает размер одного сообщения ChatCompletion в токенах.
+    """
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Обрезает текст так, чтобы он укладывался в max_tokens (оставляет конец текста).
+    """
+    max_chars = max(0, max_tokens - 1) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[-max_chars:] if max_chars else ""
+
+
+class ConversationMemory:
+    """
+    Ограниченная память диалога для каждого чата.
+
+    Последние реплики хранятся дословно, более старые в фоне сворачиваются
+    в краткое резюме. Собранный промпт никогда не превышает max_prompt_tokens,
+    поэтому задержка ответа не растёт с длиной переписки. Память о чатах,
+    молчащих дольше idle_ttl секунд, забывается; всего хранится не больше
+    max_chats чатов (вытесняются давно не писавшие).
+    """
+
+    def __init__(
+        self,
+        summarize: Callable[[int, str, List[dict]], Awaitable[str]],
+        max_prompt_tokens: int = 3000,
+        recent_tokens: int = 1500,
+        summary_tokens: int = 400,
+        min_prompt_tokens: int = 200,
+        max_chats: int = 10000,
+        idle_ttl: float = 24 * 3600,
+    ):
+        for name, value in (("max_prompt_tokens", max_prompt_tokens), ("recent_tokens", recent_tokens),
+                            ("summary_tokens", summary_tokens), ("min_prompt_tokens", min_prompt_tokens),
+                            ("max_chats", max_chats), ("idle_ttl", idle_ttl)):
+            if value <= 0:
+                raise ValueError(f"{name} должен быть положительным, получено {value}")
+        # Резюме и минимальный вопрос должны помещаться в промпт одновременно,
+        # иначе вопрос пользователя обрезался бы до пустой строки
+        required = (summary_tokens + estimate_tokens(SUMMARY_PREFIX) + MESSAGE_OVERHEAD_TOKENS
+                    + min_prompt_tokens + MESSAGE_OVERHEAD_TOKENS)
+        if max_prompt_tokens < required:
+            raise ValueError(f"max_prompt_tokens={max_prompt_tokens} меньше необходимого минимума {required} "
+                             f"(summary_tokens={summary_tokens}, min_prompt_tokens={min_prompt_tokens})")
+        if recent_tokens > max_prompt_tokens:
+            raise ValueError(f"recent_tokens={recent_tokens} больше max_prompt_tokens={max_prompt_tokens}")
+
+        self._summarize = summarize
+        self.max_prompt_tokens = max_prompt_tokens
+        self.recent_tokens = recent_tokens
+        self.summary_tokens = summary_tokens
+        self.min_prompt_tokens = min_prompt_tokens
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self._chats: "OrderedDict[int, dict]" = OrderedDict()
+
+    def _chat(self, chat_id: int) -> dict:
+        now = time.monotonic()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = {
+                "summary": "",
+                "turns": deque(),      # сообщения, хранящиеся дословно
+                "turns_tokens": 0,
+                "pending": [],         # сообщения, ожидающие сворачивания в резюме
+                "task": None,
+                "last_used": now,
+            }
+            self._chats[chat_id] = chat
+        chat["last_used"] = now
+        self._chats.move_to_end(chat_id)
+        self._evict(now)
+        return chat
+
+    def _evict(self, now: float):
+        """
+        Забывает самые давние чаты: сверх max_chats или молчащие дольше idle_ttl.
+        """
+        while self._chats:
+            chat_id, chat = next(iter(self._chats.items()))
+            if len(self._chats) <= self.max_chats and now - chat["last_used"] < self.idle_ttl:
+                break
+            del self._chats[chat_id]
+            if chat["task"] is not None:
+                chat["task"].cancel()
+
+    def has_context(self, chat_id: int) -> bool:
+        """
+        Есть ли у чата сохранённый контекст (реплики или резюме).
+        """
+        self._evict(time.monotonic())
+        chat = self._chats.get(chat_id)
+        return bool(chat and (chat["turns"] or chat["summary"] or chat["pending"]))
+
+    def build_messages(self, chat_id: int, prompt: str, system_prompt: Optional[str] = None) -> List[dict]:
+        """
+        Собирает список сообщений для ChatCompletion: системный промпт,
+        резюме старой переписки, последние реплики и новый вопрос.
+        Самые старые реплики отбрасываются, если не помещаются в бюджет.
+        """
+        chat = self._chat(chat_id)
+
+        head = []
+        if system_prompt:
+            head.append({"role": "system", "content": system_prompt})
+        budget = self.max_prompt_tokens - sum(message_tokens(m) for m in head)
+        if budget < self.min_prompt_tokens + MESSAGE_OVERHEAD_TOKENS:
+            raise ValueError("Системный промпт не оставляет места для вопроса пользователя")
+
+        # Резюме ужимается, если вместе с системным промптом оно не оставляет места вопросу
+        summary_budget = (budget - self.min_prompt_tokens - MESSAGE_OVERHEAD_TOKENS
+                          - estimate_tokens(SUMMARY_PREFIX) - MESSAGE_OVERHEAD_TOKENS)
+        summary = truncate_to_tokens(chat["summary"], summary_budget) if summary_budget > 0 else ""
+        if summary:
+            summary_message = {"role": "system", "content": f"{SUMMARY_PREFIX}{summary}"}
+            head.append(summary_message)
+            budget -= message_tokens(summary_message)
+
+        # Новый вопрос обязателен: если он сам не влезает — обрезаем его
+        prompt = truncate_to_tokens(prompt, budget - MESSAGE_OVERHEAD_TOKENS)
+        user_message = {"role": "user", "content": prompt}
+        budget -= message_tokens(user_message)
+
+        recent = []
+        for message in reversed(chat["turns"]):
+            cost = message_tokens(message)
+            if cost > budget:
+                break
+            recent.append(message)
+            budget -= cost
+        recent.reverse()
+        # Ответ без своего вопроса сбивает модель: начинаем срез с реплики пользователя
+        while recent and recent[0]["role"] == "assistant":
+            recent.pop(0)
+
+        return head + recent + [user_message]
+
+    def add_turn(self, chat_id: int, prompt: str, answer: str):
+        """
+        Запоминает пару «вопрос — ответ». Если дословная часть истории
+        превысила бюджет, старые реплики уходят на фоновое сворачивание.
+        """
+        chat = self._chat(chat_id)
+        for message in ({"role": "user", "content": prompt}, {"role": "assistant", "content": answer}):
+            chat["turns"].append(message)
+            chat["turns_tokens"] += message_tokens(message)
+
+        # Реплики уходят в резюме парами «вопрос — ответ», чтобы история начиналась с вопроса
+        while chat["turns_tokens"] > self.recent_tokens and len(chat["turns"]) > 2:
+            for _ in range(2):
+                message = chat["turns"].popleft()
+                chat["turns_tokens"] -= message_tokens(message)
+                chat["pending"].append(message)
+
+        if chat["pending"] and chat["task"] is None:
+            chat["task"] = asyncio.create_task(self._compact(chat_id))
+
+    def clear(self, chat_id: int):
+        """
+        Забывает всю историю чата (например, после /start).
+        """
+        chat = self._chats.pop(chat_id, None)
+        if chat and chat["task"] is not None:
+            chat["task"].cancel()
+
+    async def _compact(self, chat_id: int):
+        """
+        Фоновая задача: сворачивает накопившиеся старые реплики в резюме.
+        """
+        chat = self._chats.get(chat_id)
+        try:
+            while chat is not None and chat["pending"]:
+                pending, chat["pending"] = chat["pending"], []
+                try:
+                    summary = await self._summarize(chat_id, chat["summary"], pending)
+                except Exception as e:
+                    # Не смогли сжать — просто теряем старые реплики, память остаётся ограниченной
+                    logging.error(f"Ошибка при сворачивании истории чата {chat_id}: {e}")
+                    continue
+                chat["summary"] = truncate_to_tokens(summary.strip(), self.summary_tokens)
+        finally:
+            if chat is not None:
+                chat["task"] = None
@@ -0,0 +1,112 @@
+"""
+Запуск нескольких ботов в одном процессе.
+
+Вместо отдельного сервиса Railway на каждый бот все боты работают в одном
+интерпретаторе и одном event loop, используют общий пул HTTP-соединений
+к Telegram и общую aiohttp-сессию для запросов к OpenAI.
+
+Список ботов задаётся переменной окружения BOTS в формате
+"модуль=ПЕРЕМЕННАЯ_С_ТОКЕНОМ" через запятую, например:
+    BOTS="main=BOT_TOKEN,main1=YEARCOMPASS_TOKEN,main5=YEARCOMPASS_GPT_TOKEN"
+"""
+import asyncio
+import importlib
+import logging
+import os
+import signal
+
+from startup import import_now, lazy_import
+from telegram.request import HTTPXRequest
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+# openai и aiohttp импортируются в фоне, пока боты подключаются к Telegram
+openai = lazy_import("openai")
+aiohttp = lazy_import("aiohttp")
+
+
+def parse_bots(spec: str) -> list[tuple[str, str]]:
+    """
+    Разбирает строку BOTS в список пар (модуль, токен).
+    """
+    bots = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        module_name, _, token_env = item.partition("=")
+        token = os.environ.get(token_env.strip() or "TELEGRAM_BOT_TOKEN", "").strip()
+        if not token:
+            raise ValueError(f"Не найден токен для бота {module_name} в переменной {token_env}.")
+        bots.append((module_name.strip(), token))
+    return bots
+
+
+async def run(bots: list[tuple[str, str]]):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    imports = asyncio.ensure_future(asyncio.to_thread(import_now, openai, aiohttp))
+
+    # Общий пул соединений к Bot API; getUpdates у каждого бота свой (long polling)
+    request = HTTPXRequest(connection_pool_size=64)
+
+    # Сюда попадают только реально поднятые боты: если один из следующих не стартует,
+    # останавливаем и закрываем ровно их, а не все подряд
+    applications = []
+    session = None
+    try:
+        for module_name, token in bots:
+            module = importlib.import_module(module_name)
+            application = module.build_application(token, request=request)
+            await application.initialize()
+            applications.append(application)
+            # Хуки post_* PTB вызывает только из run_polling/run_webhook, а здесь
+            # жизненный цикл ведётся вручную, поэтому вызываем их сами в том же порядке
+            if application.post_init:
+                await application.post_init(application)
+            await application.updater.start_polling()
+
+        # Общая aiohttp-сессия для всех асинхронных вызовов OpenAI в этом процессе.
+        # openai.aiosession — ContextVar, поэтому задаём её до start(): задачи обработки
+        # обновлений наследуют контекст
+        await imports
+        session = aiohttp.ClientSession()
+        openai.aiosession.set(session)
+        for application in applications:
+            await application.start()
+            logging.info(f"Бот @{application.bot.username} запущен")
+
+        await stop.wait()
+    finally:
+        for application in applications:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+                if application.post_stop:
+                    await application.post_stop(application)
+        # shutdown закрывает общий пул, поэтому вызываем его только после остановки всех ботов.
+        # post_shutdown сохраняет счётчики квот и аналитику (flush_usage, flush_analytics)
+        for application in applications:
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+        if session is not None:
+            await session.close()
+
+
+def main():
+    bots = parse_bots(os.environ.get("BOTS", ""))
+    if not bots:
+        raise ValueError("Не задан список ботов в переменной окружения BOTS.")
+    asyncio.run(run(bots))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Union
+
+# Лимиты по умолчанию: окно в секундах и максимум на пользователя / на чат
+DEFAULT_QUOTAS = {
+    "requests": {"window": 3600, "user": 60, "chat": 200},
+    "tokens": {"window": 3600, "user": 20000, "chat": 60000},
+    "images": {"window": 86400, "user": 10, "chat": 30},
+}
+
+
+class SlidingWindowCounter:
+    """
+    Счётчик за скользящее окно на кольцевом буфере корзин.
+
+    Окно делится на фиксированное число корзин, поэтому память постоянна,
+    а добавление и чтение суммы выполняются за O(1).
+    """
+
+    __slots__ = ("window", "buckets", "bucket_size", "counts", "last_bucket", "total_value")
+
+    def __init__(self, window: float, buckets: int = 12):
+        self.window = window
+        self.buckets = buckets
+        self.bucket_size = window / buckets
+        self.counts = [0] * buckets
+        self.last_bucket = 0
+        self.total_value = 0
+
+    def _advance(self, now: float):
+        bucket = int(now // self.bucket_size)
+        steps = bucket - self.last_bucket
+        if steps <= 0:
+            return
+        if steps >= self.buckets:
+            self.counts = [0] * self.buckets
+            self.total_value = 0
+        else:
+            for i in range(self.last_bucket + 1, bucket + 1):
+                slot = i % self.buckets
+                self.total_value -= self.counts[slot]
+                self.counts[slot] = 0
+        self.last_bucket = bucket
+
+    def add(self, amount: int = 1, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        self._advance(now)
+        self.counts[self.last_bucket % self.buckets] += amount
+        self.total_value += amount
+
+    def total(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        self._advance(now)
+        return self.total_value
+
+    def to_dict(self) -> dict:
+        return {"last_bucket": self.last_bucket, "counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, window: float, buckets: int, data: dict) -> "SlidingWindowCounter":
+        counter = cls(window, buckets)
+        if len(data.get("counts", [])) == buckets:
+            counter.counts = list(data["counts"])
+            counter.last_bucket = data.get("last_bucket", 0)
+            counter.total_value = sum(counter.counts)
+        return counter
+
+
+class UsageMeter:
+    """
+    Учёт использования OpenAI (запросы, токены, картинки) по пользователям и чатам.
+
+    Перед каждым обращением к OpenAI вызывается try_acquire(): если квота
+    пользователя или чата исчерпана, запрос не отправляется. Счётчики хранятся
+    в памяти и периодически сбрасываются в JSON-файл, чтобы пережить перезапуск.
+
+    chat_id может быть и строкой: например, inline-запросы учитываются
+    под ключом "inline:<id пользователя>", отдельно от его личного чата.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        quotas: Optional[Dict[str, dict]] = None,
+        flush_interval: float = 60,
+        buckets: int = 12,
+    ):
+        self.path = path
+        self.quotas = quotas or DEFAULT_QUOTAS
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self._counters: Dict[str, Dict[str, SlidingWindowCounter]] = {}
+        self._lock = threading.Lock()
+        # Запись файла сериализуется отдельно, чтобы не держать _lock во время дискового I/O
+        self._write_lock = threading.Lock()
+        self._last_flush = time.time()
+        self._load()
+
+    def _counter(self, key: str, metric: str) -> SlidingWindowCounter:
+        metrics = self._counters.setdefault(key, {})
+        counter = metrics.get(metric)
+        if counter is None:
+            counter = SlidingWindowCounter(self.quotas[metric]["window"], self.buckets)
+            metrics[metric] = counter
+        return counter
+
+    def _within(self, scope: str, entity_id: Union[int, str], metric: str, amount: int, now: float) -> bool:
+        limit = self.quotas[metric].get(scope)
+        if limit is None:
+            return True
+        return self._counter(f"{scope}:{entity_id}", metric).total(now) + amount <= limit
+
+    def check(self, user_id: int, chat_id: Union[int, str], metric: str, amount: int = 1) -> bool:
+        """
+        Проверяет, что amount ещё помещается в квоту пользователя и чата.
+        """
+        now = time.time()
+        with self._lock:
+            return (self._within("user", user_id, metric, amount, now)
+                    and self._within("chat", chat_id, metric, amount, now))
+
+    def record(self, user_id: Optional[int], chat_id: Union[int, str], metric: str, amount: int = 1):
+        """
+        Учитывает фактическое использование (например, токены после ответа OpenAI).
+        user_id=None — расход без конкретного пользователя (например, фоновое
+        сжатие истории чата), он учитывается только в квоте чата.
+        """
+        now = time.time()
+        with self._lock:
+            if user_id is not None:
+                self._counter(f"user:{user_id}", metric).add(amount, now)
+            self._counter(f"chat:{chat_id}", metric).add(amount, now)
+        self.maybe_flush()
+
+    def try_acquire(self, user_id: int, chat_id: Union[int, str], *metrics: str) -> bool:
+        """
+        Атомарно проверяет квоты по всем метрикам (по одной единице каждой)
+        и, если они не исчерпаны, сразу их учитывает.
+        Для "tokens" только проверяет, что лимит ещё не достигнут:
+        фактический расход записывается через record() после ответа.
+        """
+        now = time.time()
+        with self._lock:
+            for metric in metrics:
+                if not (self._within("user", user_id, metric, 1, now)
+                        and self._within("chat", chat_id, metric, 1, now)):
+                    logging.info(f"Квота '{metric}' исчерпана: пользователь {user_id}, чат {chat_id}")
+                    return False
+            for metric in metrics:
+                if metric == "tokens":
+                    continue
+                self._counter(f"user:{user_id}", metric).add(1, now)
+                self._counter(f"chat:{chat_id}", metric).add(1, now)
+        self.maybe_flush()
+        return True
+
+    def maybe_flush(self):
+        """
+        Сохраняет счётчики на диск, если с прошлого сохранения прошло flush_interval секунд.
+        """
+        now = time.time()
+        with self._lock:
+            # Проверка и отметка под одной блокировкой: из нескольких потоков Flask
+            # сохранять будет только один
+            if now - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = now
+        self.flush()
+
+    def flush(self):
+        """
+        Сохраняет ненулевые счётчики в JSON-файл (через временный файл, атомарно).
+        """
+        with self._write_lock:
+            now = time.time()
+            with self._lock:
+                self._last_flush = now
+                # Выбрасываем ключи, по которым за окно ничего не было, — память не растёт
+                for key in list(self._counters):
+                    metrics = self._counters[key]
+                    for metric in list(metrics):
+                        if metrics[metric].total(now) == 0:
+                            del metrics[metric]
+                    if not metrics:
+                        del self._counters[key]
+                if not self.path:
+                    return
+                data = {
+                    key: {metric: counter.to_dict() for metric, counter in metrics.items()}
+                    for key, metrics in self._counters.items()
+                }
+            tmp_path = None
+            try:
+                # Уникальный временный файл: другой процесс с тем же path не испортит запись
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                                prefix=f"{os.path.basename(self.path)}.", suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logging.error(f"Не удалось сохранить счётчики использования: {e}")
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось загрузить счётчики использования: {e}")
+            return
+        for key, metrics in data.items():
+            for metric, state in metrics.items():
+                if metric in self.quotas:
+                    window = self.quotas[metric]["window"]
+                    self._counters.setdefault(key, {})[metric] = SlidingWindowCounter.from_dict(
+                        window, self.buckets, state
+                    )
@@ -0,0 +1,353 @@
+"""
+Запуск бота в нескольких процессах с разбиением чатов по воркерам.
+
+Один процесс-маршрутизатор получает обновления (polling или webhook)
+и распределяет их по N процессам-воркерам консистентным хешированием
+chat_id. Все обновления одного чата попадают в один и тот же воркер,
+поэтому сохраняются порядок сообщений и состояние ConversationHandler.
+
+Пример:
+    python sharded_runner.py main3 --workers 4
+    python sharded_runner.py main --workers 2 --webhook-url https://app.up.railway.app/telegram
+
+SIGUSR1 добавляет воркер, SIGUSR2 убирает последний добавленный. Когда чат
+переезжает на другой воркер, его состояние (chat_data и шаг ConversationHandler)
+сбрасывается на обоих воркерах: диалог начинается заново, а не продолжается
+со старого шага при возвращении чата.
+
+Ограничение: счётчики квот (quotas.py) у каждого воркера свои. Личный чат
+и inline-запросы пользователя маршрутизируются по его id и попадают в один
+воркер, поэтому там квота на пользователя соблюдается точно. Сообщения
+пользователя в разных группах могут обрабатываться разными воркерами, и в сумме
+он может израсходовать до N-кратной пользовательской квоты (квоты на чат
+соблюдаются всегда).
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from telegram import Bot, Update
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+
+class HashRing:
+    """
+    Кольцо консистентного хеширования с виртуальными узлами.
+
+    При добавлении или удалении воркера переезжает только ~1/N чатов.
+    """
+
+    def __init__(self, replicas: int = 64):
+        self.replicas = replicas
+        self._hashes: list[int] = []
+        self._nodes: dict[int, int] = {}
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def add(self, node: int):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}:{i}")
+            bisect.insort(self._hashes, h)
+            self._nodes[h] = node
+
+    def remove(self, node: int):
+        for i in range(self.replicas):
+            h = self._hash(f"{node}:{i}")
+            self._hashes.remove(h)
+            del self._nodes[h]
+
+    def get(self, key) -> int:
+        if not self._hashes:
+            raise LookupError("Нет ни одного воркера")
+        index = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._nodes[self._hashes[index]]
+
+
+def routing_key(update: Update):
+    """
+    Ключ шардирования: чат, а если чата нет (например, inline-запрос) — пользователь.
+    id личного чата совпадает с id пользователя, поэтому inline-запросы попадают
+    в тот же воркер, что и его личный чат.
+    """
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+def worker_main(module_name: str, token: str, worker_id: int, updates, acked):
+    """
+    Точка входа процесса-воркера: поднимает приложение бота и скармливает ему обновления.
+    """
+    # У каждого воркера свои файлы счётчиков квот и аналитики, чтобы процессы не перезаписывали друг друга
+    os.environ["USAGE_FILE"] = f"{os.environ.get('USAGE_FILE', 'usage.json')}.{worker_id}"
+    os.environ["ANALYTICS_SHARD"] = str(worker_id)
+    # Ctrl+C из терминала приходит всей группе процессов; останавливает воркеры маршрутизатор,
+    # чтобы они успели обработать очередь и сохранить счётчики
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    module = importlib.import_module(module_name)
+    asyncio.run(_serve(module.build_application(token), updates, acked))
+
+
+async def _serve(application, updates, acked):
+    loop = asyncio.get_running_loop()
+    pending = set()
+
+    async def process(update):
+        await application.update_processor.process_update(update, application.process_update(update))
+        # Подтверждаем только обработанное: маршрутизатор ждёт этого перед перебалансировкой
+        with acked.get_lock():
+            acked.value += 1
+
+    # Хуки post_* PTB вызывает только из run_polling/run_webhook, поэтому здесь вызываем их сами:
+    # post_shutdown сохраняет счётчики квот и аналитику воркера (flush_usage, flush_analytics)
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            if "_reset" in data:
+                _reset_chat(application, data["_reset"])
+                continue
+            update = Update.de_json(data, application.bot)
+            if application.concurrent_updates == 1:
+                # Последовательный бот (ConversationHandler): порядок важнее параллельности
+                await process(update)
+            else:
+                task = asyncio.create_task(process(update))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+        # stop() дожидается задач, запущенных через application.create_task
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def _reset_chat(application, key):
+    """
+    Забывает состояние чата, который переехал на другой воркер (или вернулся с него).
+    """
+    from telegram.ext import ConversationHandler
+
+    application.drop_chat_data(key)
+    # user_data не трогаем: она общая для всех чатов пользователя на этом воркере
+    # (в том числе групп, которые никуда не переезжали), а прогресс в ней
+    # сбрасывается сам, когда сброшенный диалог начинается заново с /start
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler) and handler.per_chat:
+                # Публичного способа сбросить диалог нет; ключ — кортеж (chat_id, user_id, ...),
+                # чат стоит первым. Сравниваем только его: личный чат и диалоги этого же
+                # пользователя в группах имеют одинаковый id на другой позиции
+                for conversation_key in [k for k in handler._conversations if k[0] == key]:
+                    del handler._conversations[conversation_key]
+    logging.info(f"Состояние чата {key} сброшено после переезда между воркерами")
+
+
+class ShardedRunner:
+    """
+    Маршрутизатор обновлений по процессам-воркерам.
+    """
+
+    def __init__(self, module_name: str, token: str, workers: int):
+        self.module_name = module_name
+        self.token = token
+        self.initial_workers = workers
+        self.ring = HashRing()
+        self._ctx = multiprocessing.get_context("spawn")
+        self._workers: dict[int, dict] = {}
+        self._next_id = 0
+        # Последний воркер каждого чата, чтобы заметить переезд и сбросить состояние
+        self._owners: "OrderedDict[object, int]" = OrderedDict()
+        self.max_owners = 100_000
+        # Маршрутизация и изменение числа воркеров не должны пересекаться
+        self._lock = asyncio.Lock()
+        self._stop = asyncio.Event()
+
+    def _spawn(self, worker_id: int) -> dict:
+        updates = self._ctx.Queue()
+        acked = self._ctx.Value("q", 0)
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(self.module_name, self.token, worker_id, updates, acked),
+            name=f"bot-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        worker = {"process": process, "updates": updates, "acked": acked, "sent": 0}
+        self._workers[worker_id] = worker
+        logging.info(f"Запущен воркер {worker_id} (pid {process.pid})")
+        return worker
+
+    async def _wait_drained(self, timeout: float = 30):
+        """
+        Ждёт, пока все воркеры обработают уже отправленные им обновления,
+        чтобы после перебалансировки не нарушился порядок внутри чата.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            if all(w["acked"].value >= w["sent"] or not w["process"].is_alive()
+                   for w in self._workers.values()):
+                return
+            await asyncio.sleep(0.05)
+        logging.warning("Не дождались обработки очередей воркеров перед перебалансировкой")
+
+    async def add_worker(self):
+        async with self._lock:
+            await self._wait_drained()
+            worker_id = self._next_id
+            self._next_id += 1
+            self._spawn(worker_id)
+            self.ring.add(worker_id)
+            logging.info(f"Воркеров: {len(self._workers)}. Часть чатов переехала на воркер {worker_id}; "
+                         "диалоги переехавших чатов начнутся заново")
+
+    async def remove_worker(self):
+        async with self._lock:
+            if len(self._workers) <= 1:
+                logging.warning("Нельзя убрать последний воркер")
+                return
+            worker_id = max(self._workers)
+            self.ring.remove(worker_id)
+            worker = self._workers.pop(worker_id)
+            worker["updates"].put(None)
+            await asyncio.get_running_loop().run_in_executor(None, worker["process"].join)
+            logging.info(f"Воркер {worker_id} остановлен, его чаты распределены между {len(self._workers)} воркерами")
+
+    async def route(self, data: dict):
+        """
+        Отправляет обновление воркеру, отвечающему за его чат.
+        """
+        update = Update.de_json(data, None)
+        key = routing_key(update)
+        async with self._lock:
+            worker_id = self.ring.get(key)
+            worker = self._workers[worker_id]
+            previous = self._owners.pop(key, None)
+            if previous is not None and previous != worker_id:
+                # Служебные сообщения не входят в sent/acked
+                if previous in self._workers:
+                    self._workers[previous]["updates"].put({"_reset": key})
+                worker["updates"].put({"_reset": key})
+            self._owners[key] = worker_id
+            if len(self._owners) > self.max_owners:
+                # Давно молчавшие чаты забываем: их состояние, скорее всего, уже неактуально
+                self._owners.popitem(last=False)
+            worker["updates"].put(data)
+            worker["sent"] += 1
+
+    async def _monitor(self):
+        """
+        Перезапускает упавшие воркеры под тем же номером, чтобы чаты не переезжали.
+        """
+        while not self._stop.is_set():
+            await asyncio.sleep(5)
+            async with self._lock:
+                for worker_id, worker in list(self._workers.items()):
+                    if not worker["process"].is_alive():
+                        logging.error(f"Воркер {worker_id} завершился (код {worker['process'].exitcode}), перезапускаем")
+                        self._spawn(worker_id)
+
+    async def _poll(self, bot: Bot):
+        await bot.delete_webhook()
+        offset = None
+        while not self._stop.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30)
+            except Exception as e:
+                logging.error(f"Ошибка при получении обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.route(update.to_dict())
+                offset = update.update_id + 1
+
+    async def _serve_webhook(self, bot: Bot, webhook_url: str, port: int):
+        from aiohttp import web
+
+        async def handle(request):
+            await self.route(await request.json())
+            return web.Response(text="OK")
+
+        app = web.Application()
+        app.router.add_post(urlsplit(webhook_url).path or "/", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+        await bot.set_webhook(webhook_url)
+        logging.info(f"Webhook установлен на {webhook_url}, слушаем порт {port}")
+        try:
+            await self._stop.wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self, webhook_url: str = "", port: int = 8080):
+        loop = asyncio.get_running_loop()
+        if self.initial_workers > 1:
+            logging.warning("Квоты считаются отдельно в каждом воркере: в группах пользователь может "
+                            f"израсходовать до {self.initial_workers}× своей квоты (см. описание модуля)")
+        for _ in range(self.initial_workers):
+            await self.add_worker()
+
+        loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(self.add_worker()))
+        loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(self.remove_worker()))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop.set)
+
+        monitor = asyncio.create_task(self._monitor())
+        async with Bot(self.token) as bot:
+            intake = asyncio.create_task(
+                self._serve_webhook(bot, webhook_url, port) if webhook_url else self._poll(bot)
+            )
+            await self._stop.wait()
+            intake.cancel()
+        monitor.cancel()
+
+        for worker in self._workers.values():
+            worker["updates"].put(None)
+        for worker in self._workers.values():
+            await loop.run_in_executor(None, worker["process"].join, 30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запуск бота в нескольких процессах с шардированием по чатам")
+    parser.add_argument("module", help="модуль бота с функцией build_application(token), например main3")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="число процессов-воркеров")
+    parser.add_argument("--webhook-url", default=os.environ.get("APP_URL", ""),
+                        help="если задан — принимаем обновления через webhook вместо polling")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8080")))
+    args = parser.parse_args()
+
+    token = os.environ.get("TELEGRAM_BOT_TOKEN") or os.environ.get("BOT_TOKEN")
+    if not token:
+        raise ValueError("Не найден TELEGRAM_BOT_TOKEN (или BOT_TOKEN) в переменных окружения.")
+
+    runner = ShardedRunner(args.module, token, max(1, args.workers))
+    asyncio.run(runner.run(args.webhook_url, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+# Отложенные импорты можно отключить (LAZY_IMPORTS=0), чтобы сравнить время старта
+LAZY_IMPORTS = os.getenv("LAZY_IMPORTS", "1") != "0"
+
+
+class StartupTimer:
+    """
+    Собирает разбивку времени старта: импорты, сборку приложения,
+    начало приёма обновлений и первое обработанное обновление.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.imports: dict[str, float] = {}
+        self._first_update_seen = False
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str):
+        """
+        Отмечает момент завершения этапа. Время считается от импорта startup.py,
+        то есть от начала импорта модуля бота, без запуска самого интерпретатора.
+        Повторная отметка того же этапа (например, из другого модуля бота) игнорируется.
+        """
+        self.phases.setdefault(phase, time.perf_counter() - self.started)
+
+    def record_import(self, name: str, seconds: float):
+        with self._lock:
+            self.imports[name] = seconds
+
+    def first_update(self):
+        """
+        Отмечает первое обработанное обновление и выводит отчёт о старте.
+        """
+        if self._first_update_seen:
+            return
+        self._first_update_seen = True
+        self.mark("первое обновление")
+        self.report()
+
+    def report(self):
+        lines = [f"  {phase}: {seconds * 1000:.0f} мс" for phase, seconds in self.phases.items()]
+        with self._lock:
+            lines += [f"  импорт {name}: {seconds * 1000:.0f} мс" for name, seconds in self.imports.items()]
+        logging.info("Время старта (отложенные импорты: %s):\n%s",
+                     "вкл" if LAZY_IMPORTS else "выкл", "\n".join(lines))
+
+
+startup_timer = StartupTimer()
+
+
+class LazyModule:
+    """
+    Заместитель модуля, который импортирует настоящий модуль при первом обращении
+    к атрибуту. configure вызывается один раз сразу после импорта
+    (например, чтобы выставить openai.api_key).
+    """
+
+    def __init__(self, name: str, configure: Optional[Callable] = None):
+        self.__dict__["_name"] = name
+        self.__dict__["_configure"] = configure
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is not None:
+            return module
+        with self.__dict__["_lock"]:
+            if self.__dict__["_module"] is None:
+                begin = time.perf_counter()
+                module = importlib.import_module(self._name)
+                if self._configure is not None:
+                    self._configure(module)
+                startup_timer.record_import(self._name, time.perf_counter() - begin)
+                self.__dict__["_module"] = module
+        return self.__dict__["_module"]
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+def lazy_import(name: str, configure: Optional[Callable] = None) -> LazyModule:
+    """
+    Возвращает отложенный модуль. При LAZY_IMPORTS=0 модуль импортируется сразу.
+    """
+    module = LazyModule(name, configure)
+    if not LAZY_IMPORTS:
+        module._load()
+    return module
+
+
+def import_now(*modules: LazyModule):
+    """
+    Импортирует отложенные модули в текущем потоке (удобно через asyncio.to_thread).
+    """
+    for module in modules:
+        module._load()
+
+
+def prefetch(*modules: LazyModule):
+    """
+    Импортирует отложенные модули в фоновом потоке, пока бот уже принимает
+    обновления, чтобы первый запрос к OpenAI не ждал импорта.
+    """
+    def load_all():
+        for module in modules:
+            try:
+                module._load()
+            except Exception as e:
+                logging.error(f"Не удалось заранее импортировать {module._name}: {e}")
+
+    threading.Thread(target=load_all, name="prefetch-imports", daemon=True).start()
+
+
+def track_first_update(application):
+    """
+    Добавляет в приложение лёгкий обработчик, который отмечает первое обновление.
+    """
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    async def mark_first_update(update, context):
+        startup_timer.first_update()
+
+    # Отдельная группа: обработчик не мешает основным хендлерам
+    application.add_handler(TypeHandler(Update, mark_first_update, block=False), group=-100)
@@ -0,0 +1,278 @@
+"""
+Опциональная трассировка обработки обновлений.
+
+Включается переменной окружения TRACE_FILE. На каждое обновление открывается
+корневой спан, внутри него — дочерние спаны для вызовов OpenAI, запросов цен
+и отправок в Telegram. Трассы пишутся в формате Chrome Trace Event
+(открываются офлайн в https://ui.perfetto.dev или chrome://tracing).
+
+Доля TRACE_PROFILE_RATE обновлений дополнительно проходит через сэмплирующий
+профайлер: стеки пишутся в TRACE_FILE + ".stacks" в формате «folded stacks»
+(подходит для flamegraph.pl и speedscope). Для async-хендлеров учитываются
+только моменты, когда выполняется задача этого обновления, а не другие
+обновления или ожидание в цикле событий.
+
+Спаны также включаются при записи трафика (CAPTURE_FILE, см. traffic.py):
+тогда длительности внешних вызовов передаются слушателям из add_listener().
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", "0"))
+TRACE_PROFILE_INTERVAL = float(os.getenv("TRACE_PROFILE_INTERVAL", "0.005"))
+
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "")
+
+enabled = bool(TRACE_FILE or CAPTURE_FILE)
+
+# Функции (name, trace_id, seconds), вызываемые по завершении каждого спана
+_listeners = []
+
+# Номер трассы (update_id) текущего обновления; в просмотрщике это отдельная дорожка
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class TraceWriter:
+    """
+    Дописывает события в файл трассы. Формат допускает отсутствие закрывающей
+    скобки массива, поэтому файл можно только дописывать.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def write(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+                if is_new:
+                    self._file.write("[\n")
+            self._file.write(line + ",\n")
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер: фоновый поток раз в interval секунд снимает стек
+    потоков, в которых сейчас обрабатываются выбранные обновления.
+
+    В async-коде поток цикла событий общий для всех обновлений, поэтому сэмпл
+    засчитывается, только если в стеке есть корневой кадр задачи обновления,
+    и сворачивается начиная с него.
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active: dict[int, tuple] = {}
+        self._thread = None
+
+    def start(self, trace_id: int) -> int:
+        token = id(object())
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        # Для синхронных хендлеров (Flask) поток занят одним запросом, корень не нужен
+        root = task.get_coro().cr_frame if task is not None else None
+        with self._lock:
+            self._active[token] = (threading.get_ident(), root, Counter())
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+                self._thread.start()
+        return token
+
+    def stop(self, token: int, trace_id: int, name: str):
+        with self._lock:
+            _, _, stacks = self._active.pop(token)
+        if not stacks:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            for stack, count in stacks.items():
+                f.write(f"{name}[{trace_id}];{stack} {count}\n")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()
+                for thread_id, root, stacks in self._active.values():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        folded = _fold(frame, root)
+                        if folded:
+                            stacks[folded] += 1
+
+
+def _fold(frame, root=None) -> str:
+    """
+    Сворачивает стек от корня к листу. Если задан root, берётся только часть
+    стека над этим кадром; если его в стеке нет, возвращается пустая строка.
+    """
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        if frame is root:
+            break
+        frame = frame.f_back
+    else:
+        if root is not None:
+            return ""
+    return ";".join(reversed(parts))
+
+
+_writer = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+_profiler = SamplingProfiler(TRACE_FILE + ".stacks", TRACE_PROFILE_INTERVAL) if TRACE_FILE else None
+_pid = os.getpid()
+
+
+def add_listener(listener):
+    """
+    Подписывает функцию listener(name, trace_id, seconds) на завершение спанов.
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def current_trace():
+    """
+    Номер трассы (update_id) обрабатываемого сейчас обновления или None.
+    """
+    return _current_trace.get()
+
+
+def bind_trace(trace_id: int):
+    """
+    Привязывает текущую задачу к трассе обновления до её завершения, чтобы спаны
+    из хендлеров без @trace_update (например, /start) тоже знали свой update_id.
+    """
+    _current_trace.set(trace_id)
+
+
+@contextmanager
+def span(name: str, **args):
+    """
+    Дочерний спан (вызов OpenAI, запрос цены, отправка в Telegram).
+    Без TRACE_FILE и CAPTURE_FILE ничего не делает.
+    """
+    if not enabled:
+        yield
+        return
+    trace_id = _current_trace.get()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - begin
+        if _writer is not None:
+            _writer.write({
+                "name": name,
+                "ph": "X",
+                "ts": int(begin * 1_000_000),
+                "dur": int(seconds * 1_000_000),
+                "pid": _pid,
+                "tid": trace_id if trace_id is not None else threading.get_ident(),
+                "args": args,
+            })
+        for listener in _listeners:
+            listener(name, trace_id, seconds)
+
+
+def _update_id(args) -> int:
+    for arg in args:
+        update_id = getattr(arg, "update_id", None)
+        if update_id is not None:
+            return update_id
+    return random.getrandbits(31)
+
+
+@contextmanager
+def _root_span(name: str, trace_id: int):
+    token = _current_trace.set(trace_id)
+    profile_token = None
+    if _profiler is not None and TRACE_PROFILE_RATE and random.random() < TRACE_PROFILE_RATE:
+        profile_token = _profiler.start(trace_id)
+    try:
+        with span(name, update_id=trace_id, profiled=profile_token is not None):
+            yield
+    finally:
+        if profile_token is not None:
+            _profiler.stop(profile_token, trace_id, name)
+        _current_trace.reset(token)
+
+
+def trace_update(func):
+    """
+    Декоратор обработчика обновления: открывает корневой спан на всё время обработки.
+    Работает и с async-хендлерами PTB, и с синхронными (Flask).
+    Если спаны выключены, возвращает функцию без изменений.
+    """
+    if not enabled:
+        return func
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with _root_span(func.__name__, _update_id(args)):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current_trace.get() is not None:
+            # Уже внутри трассы (например, handle_message вызван из webhook)
+            with span(func.__name__):
+                return func(*args, **kwargs)
+        with _root_span(func.__name__, _update_id(args)):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def traced_request(request=None):
+    """
+    Оборачивает HTTP-транспорт Telegram так, чтобы каждый вызов Bot API
+    записывался дочерним спаном. Если спаны выключены, возвращает request как есть.
+    """
+    if not enabled:
+        return request
+
+    from telegram.request import BaseRequest, HTTPXRequest
+
+    class TracingRequest(BaseRequest):
+        def __init__(self, inner):
+            self._inner = inner
+
+        @property
+        def read_timeout(self):
+            return self._inner.read_timeout
+
+        async def initialize(self):
+            await self._inner.initialize()
+
+        async def shutdown(self):
+            await self._inner.shutdown()
+
+        async def do_request(self, url, method, *args, **kwargs):
+            with span(f"telegram.{url.rsplit('/', 1)[-1]}"):
+                return await self._inner.do_request(url, method, *args, **kwargs)
+
+    return TracingRequest(request if request is not None else HTTPXRequest())
@@ -0,0 +1,349 @@
+"""
+Запись боевого трафика и его ускоренное воспроизведение.
+
+Запись: при заданной переменной окружения CAPTURE_FILE каждое входящее
+обновление и длительности внешних вызовов (OpenAI, цены, Bot API) дописываются
+в файл JSON Lines. Текст сообщений по умолчанию заменяется хешем той же длины
+(CAPTURE_HASH_TEXT=0 отключает), ключевые слова-триггеры и команды при этом
+сохраняются, чтобы при воспроизведении сообщения шли по тем же веткам обработчиков.
+Хеш солится CAPTURE_SALT, а если она не задана — случайной солью на каждый запуск.
+
+Воспроизведение:
+    python traffic.py replay capture.jsonl --bot main --speed 20 --report v2.json
+
+Обновления подаются в обработчики бота с исходными интервалами, ускоренными
+в --speed раз. Telegram, OpenAI и источники цен заменены локальными заглушками,
+которые отвечают детерминированно и «думают» столько же, сколько настоящие
+сервисы во время записи (с тем же ускорением).
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import defaultdict
+
+import tracing
+
+CAPTURE_FILE = tracing.CAPTURE_FILE
+CAPTURE_HASH_TEXT = os.getenv("CAPTURE_HASH_TEXT", "1") != "0"
+# Без соли короткие сообщения восстанавливаются перебором по словарю,
+# поэтому по умолчанию берём случайную соль на время записи
+CAPTURE_SALT = os.getenv("CAPTURE_SALT") or secrets.token_hex(16)
+
+# Слова, от которых зависит ветка обработки; при хешировании они сохраняются
+TRIGGER_WORDS = ("amybot", "нарисуй", "сделай картинку", "$")
+
+
+def hash_text(text: str) -> str:
+    """
+    Заменяет буквы и цифры текста хешем той же длины, оставляя на своих местах
+    слова-триггеры, команду в начале, пробелы и знаки препинания (от них зависят
+    проверки вроде «amybot, нарисуй»). Сообщение, целиком состоящее из триггера
+    или команды, не меняется.
+    """
+    # Посимвольно, чтобы позиции совпадали с исходным текстом даже для букв вроде «İ»
+    lowered = "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+    if lowered.strip() in TRIGGER_WORDS or (text.startswith("/") and len(text.split()) == 1):
+        return text
+
+    keep = [not char.isalnum() for char in text]
+    if text.startswith("/"):
+        keep[:len(text.split()[0])] = [True] * len(text.split()[0])
+    for word in TRIGGER_WORDS:
+        start = lowered.find(word)
+        while start != -1:
+            keep[start:start + len(word)] = [True] * len(word)
+            start = lowered.find(word, start + len(word))
+
+    # Шестнадцатеричные символы не складываются в триггеры, поэтому ветки не появятся случайно
+    filler = "".join(
+        hmac.new(CAPTURE_SALT.encode(), f"{block}:{text}".encode(), hashlib.sha256).hexdigest()
+        for block in range(len(text) // 64 + 1)
+    )
+    return "".join(char if kept else filler[i] for i, (char, kept) in enumerate(zip(text, keep)))
+
+
+def _scrub(value):
+    if isinstance(value, dict):
+        return {
+            key: hash_text(item) if key in ("text", "caption", "query") and isinstance(item, str) else _scrub(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_scrub(item) for item in value]
+    return value
+
+
+class TrafficRecorder:
+    """
+    Дописывает записи в файл захвата: одна компактная JSON-строка на событие.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._file.write(line + "\n")
+
+    def record_update(self, data: dict):
+        self.write({"k": "u", "ts": round(time.time(), 3), "d": _scrub(data) if CAPTURE_HASH_TEXT else data})
+
+    def record_span(self, name: str, trace_id, seconds: float):
+        self.write({"k": "s", "u": trace_id, "n": name, "s": round(seconds, 4)})
+
+
+recorder = TrafficRecorder(CAPTURE_FILE) if CAPTURE_FILE else None
+if recorder is not None:
+    tracing.add_listener(recorder.record_span)
+
+
+def capture_update(data: dict):
+    """
+    Записывает сырое обновление (для ботов без PTB Application, например main0.py).
+    """
+    if recorder is not None:
+        recorder.record_update(data)
+
+
+def install_capture(application):
+    """
+    Добавляет в приложение обработчик, записывающий все входящие обновления.
+    Без CAPTURE_FILE ничего не делает.
+    """
+    if recorder is None:
+        return
+
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    async def record(update, context):
+        # Спаны ищутся при воспроизведении по update_id, поэтому привязываем к нему все
+        # вызовы при обработке обновления, а не только внутри хендлеров с @trace_update
+        tracing.bind_trace(update.update_id)
+        recorder.record_update(update.to_dict())
+
+    # Самая ранняя группа и block=True: обновление записывается до основных хендлеров,
+    # а номер трассы остаётся в контексте задачи, в которой они выполняются
+    application.add_handler(TypeHandler(Update, record), group=-1000)
+
+
+# --- Воспроизведение ---------------------------------------------------------
+
+# update_id обновления, которое сейчас проигрывается (для заглушек)
+_replay_update = contextvars.ContextVar("replay_update", default=None)
+
+
+def load_capture(path: str):
+    """
+    Читает файл захвата: список обновлений и длительности внешних вызовов
+    по (update_id, имя спана) в порядке их выполнения.
+    """
+    updates, timings = [], defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["k"] == "u":
+                updates.append((record["ts"], record["d"]))
+            elif record["k"] == "s":
+                timings[(record["u"], record["n"])].append(record["s"])
+    updates.sort(key=lambda item: item[0])
+    return updates, timings
+
+
+class StandIns:
+    """
+    Локальные заглушки внешних сервисов. Каждый вызов ждёт записанную
+    длительность соответствующего спана, делённую на коэффициент ускорения.
+    """
+
+    def __init__(self, timings: dict, speed: float):
+        self.timings = {key: list(values) for key, values in timings.items()}
+        self.speed = speed
+        self.calls = defaultdict(int)
+
+    async def wait(self, name: str):
+        self.calls[name] += 1
+        durations = self.timings.get((_replay_update.get(), name))
+        if durations:
+            await asyncio.sleep(durations.pop(0) / self.speed)
+
+    def telegram_request(self):
+        from telegram.request import BaseRequest
+
+        stand_ins = self
+
+        class StandInRequest(BaseRequest):
+            """
+            Bot API без сети: на любой метод отвечает правдоподобным результатом.
+            """
+
+            @property
+            def read_timeout(self):
+                return None
+
+            async def initialize(self):
+                pass
+
+            async def shutdown(self):
+                pass
+
+            async def do_request(self, url, method, request_data=None, *args, **kwargs):
+                endpoint = url.rsplit("/", 1)[-1]
+                await stand_ins.wait(f"telegram.{endpoint}")
+                params = request_data.parameters if request_data is not None else {}
+                if endpoint == "getMe":
+                    result = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot",
+                              "can_join_groups": True, "can_read_all_group_messages": False,
+                              "supports_inline_queries": True}
+                elif endpoint.startswith("send") or endpoint.startswith("edit"):
+                    result = {"message_id": stand_ins.calls[f"telegram.{endpoint}"], "date": int(time.time()),
+                              "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                              "text": params.get("text", "")}
+                else:
+                    result = True
+                return 200, json.dumps({"ok": True, "result": result}).encode()
+
+        return StandInRequest()
+
+    def patch_openai(self):
+        import openai
+
+        async def chat(*args, **kwargs):
+            await self.wait("openai.chat")
+            content = f"replay answer #{self.calls['openai.chat']}"
+            return {"choices": [{"message": {"content": content}}], "usage": {"total_tokens": 100}}
+
+        async def image(*args, **kwargs):
+            await self.wait("openai.image")
+            return {"data": [{"url": "https://example.invalid/replay.png"}]}
+
+        openai.ChatCompletion.acreate = chat
+        openai.Image.acreate = image
+
+    def patch_module(self, module):
+        """
+        Заменяет функции получения цен и сжатия истории в модуле бота, если они есть.
+        """
+        if hasattr(module, "get_btc_price"):
+            async def get_btc_price():
+                await self.wait("coindesk.price")
+                return "Текущая цена биткоина: 0.00 USD"
+            module.get_btc_price = get_btc_price
+
+        if hasattr(module, "summarize_history"):
+            # Резюме тоже идёт через ChatCompletion, но записано отдельным спаном,
+            # поэтому подменяется отдельно и не съедает длительности openai.chat
+            async def summarize_history(*args, **kwargs):
+                await self.wait("openai.summary")
+                return f"replay summary #{self.calls['openai.summary']}"
+            module.summarize_history = summarize_history
+            memory = getattr(module, "conversation_memory", None)
+            if memory is not None:
+                memory._summarize = summarize_history
+
+
+def _percentile_ms(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return round(sorted_values[index] * 1000, 1)
+
+
+async def replay(path: str, bot: str, speed: float) -> dict:
+    updates, timings = load_capture(path)
+    stand_ins = StandIns(timings, speed)
+    stand_ins.patch_openai()
+    module = importlib.import_module(bot)
+    stand_ins.patch_module(module)
+
+    from telegram import Update
+
+    application = module.build_application("123456:replay", request=stand_ins.telegram_request())
+    latencies = []
+
+    async def process(data: dict):
+        update = Update.de_json(data, application.bot)
+        _replay_update.set(update.update_id)
+        begin = time.perf_counter()
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - begin)
+
+    async with application:
+        # start() нужен для задач из application.create_task (например, итог YearCompass):
+        # stop() дожидается их завершения
+        await application.start()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first_ts = updates[0][0] if updates else 0
+        tasks = []
+        for ts, data in updates:
+            delay = started + (ts - first_ts) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(process(data)))
+        await asyncio.gather(*tasks)
+        await application.stop()
+        elapsed = loop.time() - started
+
+    latencies.sort()
+    return {
+        "bot": bot,
+        "updates": len(updates),
+        "speed": speed,
+        "elapsed_s": round(elapsed, 3),
+        "latency_p50_ms": _percentile_ms(latencies, 0.5),
+        "latency_p95_ms": _percentile_ms(latencies, 0.95),
+        "latency_max_ms": _percentile_ms(latencies, 1.0),
+        "upstream_calls": dict(sorted(stand_ins.calls.items())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="проиграть файл захвата через обработчики бота")
+    replay_parser.add_argument("capture", help="файл, записанный с CAPTURE_FILE")
+    replay_parser.add_argument("--bot", default="main", help="модуль бота с build_application(token, request)")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="ускорение (1–100)")
+    replay_parser.add_argument("--report", help="куда сохранить отчёт в JSON для сравнения версий")
+    args = parser.parse_args()
+
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed должен быть в диапазоне 1–100")
+    # tracing читает эти переменные при импорте, поэтому запись нельзя выключить здесь
+    if CAPTURE_FILE:
+        parser.error("уберите CAPTURE_FILE: воспроизведение не должно записывать новый захват")
+    if tracing.TRACE_FILE and os.path.abspath(tracing.TRACE_FILE) == os.path.abspath(args.capture):
+        parser.error("TRACE_FILE совпадает с файлом захвата")
+
+    # Заглушки не должны трогать боевые файлы счётчиков и аналитики
+    os.environ["USAGE_FILE"] = ""
+    os.environ["ANALYTICS_DIR"] = ""
+    os.environ.setdefault("OPENAI_API_KEY", "replay")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = asyncio.run(replay(args.capture, args.bot, args.speed))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()